@@ -1,10 +1,22 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import functools
 import json
 import hashlib
 import hmac
 import os
 import sys
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from dotenv import load_dotenv
 load_dotenv(os.path.join(os.path.dirname(__file__), ".env.local"))
@@ -13,6 +25,17 @@ API_HOST = "https://api.bitkub.com"
 API_KEY = os.getenv("API_KEY")
 API_SECRET = os.getenv("API_SECRET")
 
+# last, highestBid and lowestAsk of one symbol
+Ticker = namedtuple('Ticker', ['last', 'bid', 'ask'])
+
+# reuse one keep-alive connection for all api calls
+# urllib3 does not retry POST after a request was sent, so orders are not resent
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.2,
+                      status_forcelist=[429, 500, 502, 503, 504])))
+
 # check balances
 header = {
     'Accept': 'application/json',
@@ -21,14 +44,23 @@ header = {
 }
 
 
+# daily log file, kept open between messages
+log_file = None
+log_lock = threading.Lock()
+
+
 def create_log(msg):
-    d = datetime.now()
+    global log_file
+    stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     fileName = os.path.join(os.path.dirname(__file__),
-                            f"logs/{d.strftime('%Y-%m-%d')}-log.txt")
-    with open(fileName, "a") as f:
-        # Append 'hello' at the end of file
-        f.write(f"{d.strftime('%Y-%m-%d %H:%M:%S')} {msg}\n")
-        f.close()
+                            f"logs/{stamp[:10]}-log.txt")
+    with log_lock:
+        if log_file is None or log_file.name != fileName:
+            if log_file is not None:
+                log_file.close()
+            # line buffered so every message still reaches disk
+            log_file = open(fileName, "a", buffering=1)
+        log_file.write(f"{stamp} {msg}\n")
 
 
 # encode
@@ -36,83 +68,79 @@ def json_encode(data):
     return json.dumps(data, separators=(',', ':'), sort_keys=True)
 
 
+# keyed hmac state, built once and copied per signature
+@functools.lru_cache(maxsize=1)
+def hmac_base():
+    return hmac.new(bytes(API_SECRET, "utf-8"), digestmod=hashlib.sha256)
+
+
+# decode response, with orjson when installed
+def json_decode(response):
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+# bitkub reports failures as {"error": N} with http 200
+def check_error(obj):
+    if obj.get("error", 0) != 0:
+        raise RuntimeError(f"Bitkub error {obj['error']}")
+
+
 # create signature
 def sign(data):
     j = json_encode(data)
-    h = hmac.new(bytes(API_SECRET, "utf-8"),
-                 msg=j.encode(), digestmod=hashlib.sha256)
+    h = hmac_base().copy()
+    h.update(j.encode())
     return h.hexdigest()
 
 
-# check server time
-def server_time():
-    response = requests.get(f'{API_HOST}/api/servertime')
-    ts = int(response.text)
+# offset of server clock from local clock, fetched once per process
+@functools.lru_cache(maxsize=1)
+def server_offset():
+    response = session.get(f'{API_HOST}/api/servertime')
     #print('Server time: ' + response.text)
-    return ts
-
+    return int(response.text) - int(time.time())
 
-def get_price(symbol):
-    pair = f"THB_{symbol}"
-    response = requests.request(
-        "GET", f"{API_HOST}/api/market/ticker?sym={pair}")
-    lastPrice = [0, 0, 0]
-    if response.status_code == 200:
-        obj = response.json()
-        if len(obj) > 0:
-            # last ราคาล่าสุด
-            # highestBid รายคาซื้อ
-            # lowestAsk ราคาขาย
-            lastPrice = [
-                float(obj[pair]["last"]),
-                float(obj[pair]["highestBid"]),
-                float(obj[pair]["lowestAsk"])
-            ]
-    # print(response.text)
-    return lastPrice
 
+# check server time
+def server_time():
+    return int(time.time()) + server_offset()
+
+
+# fetch ticker for all symbols in one call
+def get_prices(symbols):
+    response = session.request("GET", f"{API_HOST}/api/market/ticker")
+    # zero prices would read as an empty position and trigger a buy,
+    # so any error or missing pair raises instead
+    response.raise_for_status()
+    obj = json_decode(response)
+    check_error(obj)
+    prices = {}
+    for symbol in symbols:
+        pair = f"THB_{symbol}"
+        if pair not in obj:
+            raise KeyError(pair)
+        # last ราคาล่าสุด
+        # highestBid รายคาซื้อ
+        # lowestAsk ราคาขาย
+        prices[symbol] = Ticker(
+            float(obj[pair]["last"]),
+            float(obj[pair]["highestBid"]),
+            float(obj[pair]["lowestAsk"])
+        )
+    return prices
 
-def buy(symbol, amount, rate, market='limit'):
-    if amount > 50:
-        data = {
-            'sym': f'THB_{symbol}',
-            'amt': amount,  # THB amount you want to spend
-            'rat': rate,
-            'typ': market,  # market or limit
-            'ts': server_time(),
-        }
-
-        signature = sign(data)
-        data['sig'] = signature
-
-        # print('Payload with signature: ' + json_encode(data))
-        response = requests.post(f'{API_HOST}/api/market/place-bid',
-                                 headers=header, data=json_encode(data))
-
-        obj = response.json()["result"]
-        id = obj["id"]  # "id": 1, // order id
-        # "hash": "fwQ6dnQWQPs4cbatFGc9LPnpqyu", // order hash
-        hash = obj["hash"]
-        typ = obj["typ"]  # "typ": "limit", // order type
-        amt = obj["amt"]  # "amt": 1.00000000, // selling amount
-        rat = obj["rat"]  # "rat": 15000, // rate
-        fee = obj["fee"]  # "fee": 37.5, // fee
-        cre = obj["cre"]  # "cre": 37.5, // fee credit used
-        rec = obj["rec"]  # "rec": 15000, // amount to receive
-        ts = obj["ts"]  # "ts": 1533834844 // timestamp
-        msg = f"Buy id: {id} hash: {hash} typ: {typ} amt: {amt} rat: {rat} fee: {fee}"
-        create_log(msg)
-
-        print('Buy Response: ' + response.text)
-        return response.status_code
 
-    return 500
+def get_price(symbol):
+    return get_prices([symbol])[symbol]
 
 
-def sell(symbol, amount, rate, market='limit'):
+# bid and ask share the same payload and response
+def place_order(path, side, symbol, amount, rate, market):
     data = {
         'sym': f'THB_{symbol}',
-        'amt': amount,  # THB amount you want to spend
+        'amt': amount,  # THB amount to spend for bid, coin amount for ask
         'rat': rate,
         'typ': market,  # market or limit
         'ts': server_time(),
@@ -122,10 +150,12 @@ def sell(symbol, amount, rate, market='limit'):
     data['sig'] = signature
 
     # print('Payload with signature: ' + json_encode(data))
-    response = requests.post(f'{API_HOST}/api/market/place-ask',
-                             headers=header, data=json_encode(data))
+    response = session.post(f'{API_HOST}{path}',
+                            headers=header, data=json_encode(data).encode())
 
-    obj = response.json()["result"]
+    obj = json_decode(response)
+    check_error(obj)
+    obj = obj["result"]
     id = obj["id"]  # "id": 1, // order id
     hash = obj["hash"]  # "hash": "fwQ6dnQWQPs4cbatFGc9LPnpqyu", // order hash
     typ = obj["typ"]  # "typ": "limit", // order type
@@ -135,12 +165,25 @@ def sell(symbol, amount, rate, market='limit'):
     cre = obj["cre"]  # "cre": 37.5, // fee credit used
     rec = obj["rec"]  # "rec": 15000, // amount to receive
     ts = obj["ts"]  # "ts": 1533834844 // timestamp
-    msg = f"Sell id: {id} hash: {hash} typ: {typ} amt: {amt} rat: {rat} fee: {fee}"
+    msg = f"{side} id: {id} hash: {hash} typ: {typ} amt: {amt} rat: {rat} fee: {fee}"
     create_log(msg)
-    print('Sell Response: ' + response.text)
+    print(f'{side} Response: ' + response.text)
     return response.status_code
 
 
+def buy(symbol, amount, rate, market='limit'):
+    if amount > 50:
+        return place_order('/api/market/place-bid', 'Buy',
+                           symbol, amount, rate, market)
+
+    return 500
+
+
+def sell(symbol, amount, rate, market='limit'):
+    return place_order('/api/market/place-ask', 'Sell',
+                       symbol, amount, rate, market)
+
+
 def cancel(symbol, order_id, sd, txt_hash):
     data = {
         'sym': f'THB_{symbol}',
@@ -154,8 +197,8 @@ def cancel(symbol, order_id, sd, txt_hash):
     data['sig'] = signature
 
     # print('Payload with signature: ' + json_encode(data))
-    response = requests.post(f'{API_HOST}/api/market/cancel-order',
-                             headers=header, data=json_encode(data))
+    response = session.post(f'{API_HOST}/api/market/cancel-order',
+                            headers=header, data=json_encode(data).encode())
     # obj = response.json()
     msg = f"Cancel id: {id} hash: {hash} sts: {response.status_code}"
     create_log(msg)
@@ -163,24 +206,22 @@ def cancel(symbol, order_id, sd, txt_hash):
 
 
 def check_order_hold(symbol):
-    try:
-        data = {
-            'sym': f'THB_{symbol}',
-            'ts': server_time(),
-        }
-
-        signature = sign(data)
-        data['sig'] = signature
-
-        # print('Payload with signature: ' + json_encode(data))
-        response = requests.post(f'{API_HOST}/api/market/my-open-orders',
-                                 headers=header, data=json_encode(data))
-        return response.json()["result"]
+    data = {
+        'sym': f'THB_{symbol}',
+        'ts': server_time(),
+    }
 
-    except Exception as e:
-        pass
+    signature = sign(data)
+    data['sig'] = signature
 
-    return []
+    # print('Payload with signature: ' + json_encode(data))
+    # let failures raise, an empty list would let a duplicate order through
+    response = session.post(f'{API_HOST}/api/market/my-open-orders',
+                            headers=header, data=json_encode(data).encode())
+    response.raise_for_status()
+    obj = json_decode(response)
+    check_error(obj)
+    return obj["result"]
 
 
 def fetch_balance():
@@ -190,69 +231,94 @@ def fetch_balance():
     signature = sign(data)
     data['sig'] = signature
     #print('Payload with signature: ' + json_encode(data))
-    response = requests.post(f'{API_HOST}/api/market/balances',
-                             headers=header, data=json_encode(data))
-    data = response.json()
+    response = session.post(f'{API_HOST}/api/market/balances',
+                            headers=header, data=json_encode(data).encode())
+    response.raise_for_status()
+    data = json_decode(response)
+    check_error(data)
     data = data['result']
     return data
 
 
-def main():
-    sym = ['XRP', 'TRX']
-    data = fetch_balance()
-    # Start Bot
-    cost = 300
-    baseTotal = 0  # float(data["THB"]['available'])
-    for s in sym:
-        fetchPrice = get_price(s)
-        baseTotal += (float(fetchPrice[0]) * float(data[s]['available']))
-
-    for i in range(0, len(sym)):
-        symbol = sym[i]
-        fetchPrice = get_price(symbol)
-        baseAsset = float(data[symbol]['available'])
-        assetPrice = fetchPrice[0] * baseAsset
-        assetBidPrice = fetchPrice[1]
-        assetAskPrice = fetchPrice[2]
+def trade(symbol, baseAsset, fetchPrice, costDivided):
+    assetPrice = fetchPrice.last * baseAsset
+    assetBidPrice = fetchPrice.bid
+    assetAskPrice = fetchPrice.ask
 
-        costDivided = int(baseTotal)
-        if costDivided == 0:
-            costDivided = cost/len(sym)
+    # ตรวจสอบ Asset
+    if int(assetPrice) == 0:
+        # ตรวจสอบรายการ Hold
+        isHold = check_order_hold(symbol)
+        if len(isHold) == 0:
+            isStatus = buy(symbol, costDivided,
+                           assetBidPrice, market='market')
+            print(f"Open Order {symbol} Status: {isStatus}")
 
         else:
-            # if baseTotal >= cost:
-            #     costDivided = int(baseTotal)/len(sym)
-            costDivided = cost/len(sym)
-            if float(data["THB"]['available']) < costDivided:
-                costDivided = float(data["THB"]['available'])
-
-        # ตรวจสอบ Asset
-        if int(assetPrice) == 0:
-            # ตรวจสอบรายการ Hold
+            msg = f"Hold {isHold[0]['side']} Order {symbol} ID: {isHold[0]['id']}"
+            create_log(msg)
+
+    else:
+        percentDivided = round(
+            ((assetPrice-costDivided)*100)/costDivided, 2)
+        print(f"{symbol} Asset: {baseAsset} Price: {assetPrice} Profit: {round((assetPrice-costDivided), 2)} Percent: {percentDivided}%")
+        if percentDivided > 5 or percentDivided < -3:
             isHold = check_order_hold(symbol)
             if len(isHold) == 0:
-                isStatus = buy(symbol, costDivided,
-                               assetBidPrice, market='market')
-                print(f"Open Order {symbol} Status: {isStatus}")
-
+                isStatus = sell(symbol, baseAsset, assetAskPrice)
+                print(f"Sell Order {symbol} Status: {isStatus}")
             else:
                 msg = f"Hold {isHold[0]['side']} Order {symbol} ID: {isHold[0]['id']}"
                 create_log(msg)
 
-        else:
-            percentDivided = round(
-                ((assetPrice-costDivided)*100)/costDivided, 2)
-            print(f"{symbol} Asset: {baseAsset} Price: {assetPrice} Profit: {round((assetPrice-costDivided), 2)} Percent: {percentDivided}%")
-            if percentDivided > 5 or percentDivided < -3:
-                isHold = check_order_hold(symbol)
-                if len(isHold) == 0:
-                    isStatus = sell(symbol, baseAsset, assetAskPrice)
-                    print(f"Sell Order {symbol} Status: {isStatus}")
-                else:
-                    msg = f"Hold {isHold[0]['side']} Order {symbol} ID: {isHold[0]['id']}"
-                    create_log(msg)
+
+def main():
+    sym = ['XRP', 'TRX']
+    # balance and ticker do not depend on each other, fetch them together
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        balanceJob = ex.submit(fetch_balance)
+        pricesJob = ex.submit(get_prices, sym)
+    data = balanceJob.result()
+    prices = pricesJob.result()
+    # Start Bot
+    cost = 300
+    baseTotal = 0  # float(data["THB"]['available'])
+    for s in sym:
+        fetchPrice = prices[s]
+        baseTotal += (float(fetchPrice.last) * float(data[s]['available']))
+
+    costDivided = int(baseTotal)
+    if costDivided == 0:
+        costDivided = cost/len(sym)
+
+    else:
+        # if baseTotal >= cost:
+        #     costDivided = int(baseTotal)/len(sym)
+        costDivided = cost/len(sym)
+        if float(data["THB"]['available']) < costDivided:
+            costDivided = float(data["THB"]['available'])
+
+    # symbols are independent, check and place their orders concurrently
+    with ThreadPoolExecutor(max_workers=len(sym)) as ex:
+        jobs = [ex.submit(trade, symbol, float(data[symbol]['available']),
+                          prices[symbol], costDivided) for symbol in sym]
+    # log every failed symbol, not only the first one raised
+    errors = []
+    for symbol, job in zip(sym, jobs):
+        error = job.exception()
+        if error is not None:
+            create_log(f"Error {symbol}: {error!r}")
+            errors.append(error)
+    if errors:
+        raise errors[0]
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        session.close()
+        with log_lock:
+            if log_file is not None:
+                log_file.close()
     sys.exit(0)